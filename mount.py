@@ -2,87 +2,505 @@
 
 import os
 import sys
+import mmap
+import time
+import zlib
 import errno
+import struct
+import logging
 import zipfile
-from fuse import FUSE, Operations, LoggingMixIn
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from cachetools import LRUCache
+from fuse import FUSE, Operations
 
-class ZipFS(LoggingMixIn, Operations):
-    def __init__(self, zip_path):
+log = logging.getLogger(__name__)
+
+CACHE_SIZE = 100 * 1024 * 1024
+# files up to this size are cached whole, larger ones in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+# members with a live decompressor kept for sequential reads
+MAX_STREAMS = 32
+# with parse workers enabled, central directories with at least this many
+# records are decoded in parallel, by at most MAX_PARSE_WORKERS processes
+PARALLEL_THRESHOLD = 100000
+MAX_PARSE_WORKERS = 8
+# a .ufdr keeps its XML report ahead of the archive, exposed under this name
+METADATA_NAME = 'metadata.xml'
+METADATA_PATH = '/' + METADATA_NAME
+
+_EOCD = struct.Struct('<4s4H2LH')
+_EOCD64_LOCATOR = struct.Struct('<4sLQL')
+_EOCD64 = struct.Struct('<4sQ2H2L4Q')
+_CD_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_CD_LENGTHS = struct.Struct('<3H')
+_LOCAL_HEADER_SIZE = 30
+_ZIP64_EXTRA = 0x0001
+_FLAG_ENCRYPTED = 0x1
+_FLAG_UTF8 = 0x800
+
+
+class _Inflater:
+    # forward-only raw deflate decoder over one member's compressed bytes
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, fd, start, length):
+        self._fd = fd
+        self._raw_pos = start
+        self._raw_end = start + length
+        self._dobj = zlib.decompressobj(-15)
+        self.pos = 0
+
+    def read(self, size):
+        parts = []
+        while size > 0 and not self._dobj.eof:
+            data = self._dobj.unconsumed_tail
+            if not data:
+                if self._raw_pos >= self._raw_end:
+                    break
+                data = os.pread(self._fd, min(self.READ_SIZE, self._raw_end - self._raw_pos), self._raw_pos)
+                if not data:
+                    break
+                self._raw_pos += len(data)
+            out = self._dobj.decompress(data, size)
+            parts.append(out)
+            size -= len(out)
+            self.pos += len(out)
+        return b''.join(parts)
+
+    def seek(self, offset):
+        while self.pos < offset and self.read(min(CHUNK_SIZE, offset - self.pos)):
+            pass
+
+
+def _decode_records(mm, pos, count, concat):
+    # decode `count` consecutive central directory records starting at `pos`;
+    # every output is allocated once at its final size and records are
+    # decoded in place from the mapping
+    names = [None] * count
+    sizes = array('Q', [0]) * count
+    compress_sizes = array('Q', [0]) * count
+    header_offsets = array('Q', [0]) * count
+    compress_types = array('H', [0]) * count
+    flag_bits = array('H', [0]) * count
+    # unix mtimes, converted once here so getattr only indexes the array;
+    # archives repeat timestamps heavily, so conversions are memoized
+    mtimes = array('I', [0]) * count
+    unix_times = {}
+    unpack_from = _CD_HEADER.unpack_from
+    for index in range(count):
+        try:
+            (signature, _, _, _, _, flags, compress_type, dos_time, dos_date, _,
+             compress_size, size, name_len, extra_len, comment_len,
+             _, _, _, header_offset) = unpack_from(mm, pos)
+        except struct.error:
+            raise zipfile.BadZipFile("Truncated central directory") from None
+        if signature != b'PK\x01\x02':
+            raise zipfile.BadZipFile("Bad magic number for central directory")
+        pos += _CD_HEADER.size
+        names[index] = mm[pos:pos + name_len].decode('utf-8' if flags & _FLAG_UTF8 else 'cp437')
+        if 0xFFFFFFFF in (size, compress_size, header_offset):
+            size, compress_size, header_offset = _zip64_fields(
+                mm[pos + name_len:pos + name_len + extra_len], size, compress_size, header_offset)
+        pos += name_len + extra_len + comment_len
+        sizes[index] = size
+        compress_sizes[index] = compress_size
+        header_offsets[index] = concat + header_offset
+        compress_types[index] = compress_type
+        flag_bits[index] = flags
+        dos_datetime = dos_date << 16 | dos_time
+        mtime = unix_times.get(dos_datetime)
+        if mtime is None:
+            mtime = unix_times[dos_datetime] = _dos_to_unix(dos_datetime)
+        mtimes[index] = mtime
+    data_offsets = _find_data_offsets(mm, header_offsets)
+    return names, sizes, compress_sizes, header_offsets, compress_types, flag_bits, mtimes, data_offsets
+
+
+def _find_data_offsets(mm, header_offsets):
+    # resolve every local header once at mount, in file order, so reads go
+    # straight to the member data; 0 marks a header that is missing
+    offsets = array('Q', [0]) * len(header_offsets)
+    for index in sorted(range(len(offsets)), key=header_offsets.__getitem__):
+        pos = header_offsets[index]
+        if pos + _LOCAL_HEADER_SIZE <= len(mm) and mm[pos:pos + 4] == b'PK\x03\x04':
+            name_len, extra_len = struct.unpack_from('<HH', mm, pos + 26)
+            offsets[index] = pos + _LOCAL_HEADER_SIZE + name_len + extra_len
+    return offsets
+
+
+def _zip64_fields(extra, size, compress_size, header_offset):
+    # the zip64 extra field holds, in order, only the values whose 32-bit
+    # central directory fields are saturated
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from('<HH', extra, pos)
+        if tag == _ZIP64_EXTRA:
+            try:
+                values = iter(struct.unpack_from('<%dQ' % (length // 8), extra, pos + 4))
+                if size == 0xFFFFFFFF:
+                    size = next(values)
+                if compress_size == 0xFFFFFFFF:
+                    compress_size = next(values)
+                if header_offset == 0xFFFFFFFF:
+                    header_offset = next(values)
+            except (struct.error, StopIteration):
+                raise zipfile.BadZipFile("Corrupt zip64 extra field") from None
+            break
+        pos += 4 + length
+    return size, compress_size, header_offset
+
+
+def _find_eocd(mm):
+    # the end record sits at the very end unless the archive has a comment;
+    # a candidate found by scanning back only counts if its comment length
+    # reaches exactly to the end, since the comment may contain the signature
+    end = len(mm) - _EOCD.size
+    if mm[end:end + 4] == b'PK\x05\x06' and mm[end + 20:end + 22] == b'\0\0':
+        return end
+    start = max(0, end - 0xFFFF)
+    pos = mm.rfind(b'PK\x05\x06', start, end)
+    while pos >= 0:
+        comment_len, = struct.unpack_from('<H', mm, pos + 20)
+        if pos + _EOCD.size + comment_len == len(mm):
+            return pos
+        pos = mm.rfind(b'PK\x05\x06', start, pos)
+    raise zipfile.BadZipFile("File is not a zip file")
+
+
+def _record_runs(mm, pos, count, parts):
+    # split the directory into `parts` runs of records, reading only the
+    # length fields to find where each run starts
+    step = -(-count // parts)
+    runs = []
+    for index in range(count):
+        if index % step == 0:
+            runs.append((pos, min(step, count - index)))
+        try:
+            name_len, extra_len, comment_len = _CD_LENGTHS.unpack_from(mm, pos + 28)
+        except struct.error:
+            raise zipfile.BadZipFile("Truncated central directory") from None
+        pos += _CD_HEADER.size + name_len + extra_len + comment_len
+    return runs
+
+
+def _available_cpus():
+    # cpu_count() reports every host core, even under affinity or cgroup
+    # limits; the affinity mask is what this process may actually use
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+_worker_mm = None
+
+
+def _init_worker(zip_path):
+    global _worker_mm
+    with open(zip_path, 'rb') as f:
+        _worker_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _decode_run(pos, count, concat):
+    return _decode_records(_worker_mm, pos, count, concat)
+
+
+class ZipFS(Operations):
+    def __init__(self, zip_path, parse_workers=1):
         self.zip_path = zip_path
-        self.zip_file = zipfile.ZipFile(zip_path, 'r')
-        self.files = {info.filename: info for info in self.zip_file.infolist()}
-        self.directories = self._build_directory_structure()
-
-    def _build_directory_structure(self):
-        dirs = {'/': []}
-        for file in self.files:
-            path_parts = file.strip('/').split('/')
-            for i in range(1, len(path_parts)):
-                dir_path = '/' + '/'.join(path_parts[:i]) + '/'
-                if dir_path not in dirs:
-                    dirs[dir_path] = []
-            if file.endswith('/'):
-                dirs['/' + '/'.join(path_parts) + '/'] = []
-            else:
-                parent_dir = '/' + '/'.join(path_parts[:-1]) + '/'
-                if parent_dir not in dirs:
-                    dirs[parent_dir] = []
-                dirs[parent_dir].append(path_parts[-1])
+        self.parse_workers = parse_workers
+        self._fd = os.open(zip_path, os.O_RDONLY)
+        self._lock = threading.Lock()
+        # checked once so hot paths pay nothing for disabled debug logging
+        self._debug = log.isEnabledFor(logging.DEBUG)
+        # path -> (next_offset, inflater), so sequential reads continue
+        # from where the previous one stopped instead of re-decompressing;
+        # bounded because each one holds a zlib window
+        self._streams = LRUCache(maxsize=MAX_STREAMS)
+        # path -> number of open handles; open() always hands out fh 0, so a
+        # path's stream and lock are only dropped once its last handle is
+        # released
+        self._open_counts = {}
+        # path -> lock held while that member is being decompressed, so a
+        # concurrent miss waits for the chunk in progress instead of
+        # starting a second decompressor from the beginning of the member
+        self._path_locks = {}
+        self._content_cache = LRUCache(maxsize=CACHE_SIZE, getsizeof=len)
+        if os.fstat(self._fd).st_size < _EOCD.size:
+            raise zipfile.BadZipFile("File is not a zip file")
+        with mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ) as mm:
+            self._dirs = self._build_directory_structure(self._parse_central_directory(mm))
+        # the archive is immutable, so the stat fields shared by every entry
+        # are built once; directories without an archive record of their own
+        # get the epoch as mtime
+        ids = dict(st_uid=os.getuid(), st_gid=os.getgid())
+        self._dir_stat = dict(st_mode=(0o40555), st_nlink=2, st_mtime=0, st_atime=0, st_ctime=0, **ids)
+        self._file_stat = dict(st_mode=(0o100444), st_nlink=1, **ids)
+
+        # the metadata is read from the archive on demand rather than kept
+        # as a copy; 0 means the archive has none to expose
+        root = self._dirs['/']
+        self._metadata_size = 0
+        if self.zip_offset and METADATA_NAME not in root:
+            # listed like a member; None keeps it out of _find_file
+            root[METADATA_NAME] = None
+            self._metadata_size = self.zip_offset
+            self._metadata_stat = dict(self._dir_stat, st_mode=(0o100444), st_nlink=1,
+                                       st_size=self._metadata_size)
+        # the kernel may call readdir several times per listing, so every
+        # listing is built once up front
+        self._listings = {path: ['.', '..'] + sorted(node) for path, node in self._dirs.items()}
+
+    def _parse_central_directory(self, mm):
+        # walk the central directory ourselves instead of materializing a
+        # ZipInfo per entry; only the fields the filesystem uses are kept, as
+        # parallel arrays indexed like the returned list of names
+        eocd = _find_eocd(mm)
+        _, _, _, _, count, cd_size, cd_offset, _ = _EOCD.unpack_from(mm, eocd)
+        # data prepended to the archive (e.g. UFDR metadata) shifts every
+        # recorded offset by the same amount
+        concat = eocd - cd_size - cd_offset
+        locator = eocd - _EOCD64_LOCATOR.size
+        if locator >= 0 and mm[locator:locator + 4] == b'PK\x06\x07':
+            record = locator - _EOCD64.size
+            if record < 0 or mm[record:record + 4] != b'PK\x06\x06':
+                raise zipfile.BadZipFile("Corrupt zip64 end of central directory")
+            count, cd_size, cd_offset = _EOCD64.unpack_from(mm, record)[7:10]
+            concat = record - cd_size - cd_offset
+        if concat < 0:
+            raise zipfile.BadZipFile("Truncated central directory")
+        self.zip_offset = concat
+
+        pos = concat + cd_offset
+        workers = min(self.parse_workers, _available_cpus(), MAX_PARSE_WORKERS)
+        if count >= PARALLEL_THRESHOLD and workers > 1:
+            # records are independent once their start is known, so large
+            # directories are split into runs decoded by worker processes
+            runs = _record_runs(mm, pos, count, workers)
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(self.zip_path,)) as pool:
+                results = list(pool.map(_decode_run, *zip(*runs), [concat] * len(runs)))
+        else:
+            results = [_decode_records(mm, pos, count, concat)]
+
+        names, *fields = results[0]
+        for more_names, *more_fields in results[1:]:
+            names += more_names
+            for merged, more in zip(fields, more_fields):
+                merged.extend(more)
+        (self._sizes, self._compress_sizes, self._header_offsets, self._compress_types,
+         self._flags, self._mtimes, self._data_offsets) = fields
+        return names
+
+    def _data_offset(self, index):
+        offset = self._data_offsets[index]
+        if not offset:
+            raise OSError(errno.EIO, "Bad local file header")
+        return offset
+
+    def _build_directory_structure(self, names):
+        # one dict per directory mapping child names to sub-dicts, or to the
+        # entry index for files; every directory is indexed by its full path
+        # so lookups never walk the tree, while files are only kept by name
+        # under their parent and no full file path is stored
+        root = {}
+        dirs = {'/': root}
+        # directories with their own archive record, by path -> entry index
+        self._dir_entries = {}
+        for index, name in enumerate(names):
+            is_dir = name.endswith('/')
+            # archives repeat the same component names across many
+            # directories, so share one string object per distinct name
+            parts = [sys.intern(part) for part in name.strip('/').split('/')]
+            if not is_dir:
+                parts, leaf = parts[:-1], parts[-1]
+            node = root
+            for i, part in enumerate(parts):
+                child = node.get(part)
+                if not isinstance(child, dict):
+                    child = node[part] = {}
+                    dirs['/' + '/'.join(parts[:i + 1])] = child
+                node = child
+            if is_dir:
+                self._dir_entries['/' + '/'.join(parts)] = index
+            elif not isinstance(node.get(leaf), dict):
+                node[leaf] = index
         return dirs
 
-    def getattr(self, path, fh=None):
+    def _lookup(self, path):
+        # what the parent directory holds under the last component: an entry
+        # index for files, the child dict for directories, else None
         if path == '/':
-            return dict(st_mode=(0o40555), st_nlink=2)
-        if path.endswith('/'):
-            if path in self.directories:
-                return dict(st_mode=(0o40555), st_nlink=2)
-            else:
-                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            return self._dirs['/']
+        parent, _, name = path.rpartition('/')
+        node = self._dirs.get(parent or '/')
+        return node.get(name) if node is not None else None
 
-        zip_path = path.lstrip('/')
-        if zip_path in self.files:
-            info = self.files[zip_path]
-            return dict(st_mode=(0o100444), st_nlink=1, st_size=info.file_size)
-        else:
-            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    def _find_file(self, path):
+        index = self._lookup(path)
+        return index if type(index) is int else None
+
+    def getattr(self, path, fh=None):
+        entry = self._lookup(path)
+        if type(entry) is int:
+            mtime = self._mtimes[entry]
+            return dict(self._file_stat, st_size=self._sizes[entry],
+                        st_mtime=mtime, st_atime=mtime, st_ctime=mtime)
+        if entry is not None:
+            index = self._dir_entries.get(path)
+            if index is None:
+                return self._dir_stat
+            mtime = self._mtimes[index]
+            return dict(self._dir_stat, st_mtime=mtime, st_atime=mtime, st_ctime=mtime)
+        if path == METADATA_PATH and self._metadata_size:
+            return self._metadata_stat
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
     def readdir(self, path, fh):
-        yield '.'
-        yield '..'
-        if path == '/':
-            entries = [name.strip('/') for name in self.directories['/']]
-            entries += [d.strip('/').split('/')[-1] for d in self.directories if d != '/']
-            for entry in sorted(set(entries)):
-                yield entry
-        elif path in self.directories:
-            for entry in self.directories[path]:
-                yield entry
-            subdirs = [d for d in self.directories if d.startswith(path) and d != path]
-            for subdir in subdirs:
-                subdir_name = subdir[len(path):].strip('/').split('/')[0]
-                yield subdir_name
-        else:
+        listing = self._listings.get(path)
+        if listing is None:
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return listing
 
     def open(self, path, flags):
         if flags & (os.O_WRONLY | os.O_RDWR):
             raise PermissionError(errno.EACCES, "Read-only filesystem")
-        zip_path = path.lstrip('/')
-        if zip_path in self.files:
+        index = self._find_file(path)
+        if index is not None:
+            # start reading the member's data in the background; an empty
+            # extent is skipped, a length of 0 would mean "to end of file"
+            if (hasattr(os, 'posix_fadvise') and self._data_offsets[index]
+                    and self._compress_sizes[index]):
+                os.posix_fadvise(self._fd, self._data_offsets[index],
+                                 self._compress_sizes[index], os.POSIX_FADV_WILLNEED)
+            with self._lock:
+                self._open_counts[path] = self._open_counts.get(path, 0) + 1
+            return 0
+        if path == METADATA_PATH and self._metadata_size:
             return 0
         raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
     def read(self, path, size, offset, fh):
-        zip_path = path.lstrip('/')
-        if zip_path not in self.files:
+        index = self._find_file(path)
+        if index is None:
+            if path == METADATA_PATH and self._metadata_size:
+                size = min(size, self._metadata_size - offset)
+                return os.pread(self._fd, size, offset) if size > 0 else b''
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
-        with self.zip_file.open(zip_path) as f:
-            f.seek(offset)
-            return f.read(size)
+        file_size = self._sizes[index]
+        compress_type = self._compress_types[index]
+        if (self._flags[index] & _FLAG_ENCRYPTED
+                or compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+            raise OSError(errno.EOPNOTSUPP, "Unsupported compression or encryption", path)
+        if compress_type == zipfile.ZIP_STORED:
+            # stored members need no decompression, a single pread serves them
+            size = min(size, file_size - offset)
+            return os.pread(self._fd, size, self._data_offset(index) + offset) if size > 0 else b''
+        if file_size <= CHUNK_SIZE:
+            with self._lock:
+                data = self._content_cache.get(path)
+            if data is None:
+                with self._path_lock(path):
+                    with self._lock:
+                        data = self._content_cache.get(path)
+                    if data is None:
+                        data = self._open_member(index).read(file_size)
+                        with self._lock:
+                            self._content_cache[path] = data
+            return data[offset:offset + size]
+
+        end = min(offset + size, file_size)
+        parts = []
+        for chunk_index in range(offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            chunk = self._read_chunk(path, index, chunk_index)
+            base = chunk_index * CHUNK_SIZE
+            parts.append(chunk[max(offset - base, 0):end - base])
+        return b''.join(parts)
+
+    def _read_chunk(self, path, index, chunk_index):
+        key = (path, chunk_index)
+        with self._lock:
+            chunk = self._content_cache.get(key)
+        if chunk is None:
+            with self._path_lock(path):
+                # another reader may have decoded it while this one waited
+                with self._lock:
+                    chunk = self._content_cache.get(key)
+                if chunk is None:
+                    chunk = self._read_stream(path, index, chunk_index * CHUNK_SIZE, CHUNK_SIZE)
+                    with self._lock:
+                        self._content_cache[key] = chunk
+        return chunk
+
+    def _path_lock(self, path):
+        with self._lock:
+            lock = self._path_locks.get(path)
+            if lock is None:
+                lock = self._path_locks[path] = threading.Lock()
+            return lock
+
+    def _read_stream(self, path, index, offset, size):
+        # only called under the path's lock, so one path's stream is never
+        # used by two readers at once
+        with self._lock:
+            next_offset, f = self._streams.pop(path, (None, None))
+        if f is None or offset < next_offset:
+            if self._debug:
+                log.debug("inflating %s from the start for offset %d", path, offset)
+            f = self._open_member(index)
+        # forward seeks only decompress the gap from the current position
+        f.seek(offset)
+        data = f.read(size)
+        with self._lock:
+            self._streams[path] = (offset + len(data), f)
+        return data
+
+    def _open_member(self, index):
+        return _Inflater(self._fd, self._data_offset(index), self._compress_sizes[index])
+
+    def release(self, path, fh):
+        with self._lock:
+            count = self._open_counts.get(path, 0) - 1
+            if count > 0:
+                self._open_counts[path] = count
+            else:
+                self._open_counts.pop(path, None)
+                self._streams.pop(path, None)
+                self._path_locks.pop(path, None)
+        return 0
+
+    def destroy(self, path):
+        with self._lock:
+            self._streams.clear()
+            self._open_counts.clear()
+            self._path_locks.clear()
+        os.close(self._fd)
+
+
+def _dos_to_unix(dos_datetime):
+    # clamped to what array('I') holds; DOS times run from 1980 to 2107
+    date, time_ = dos_datetime >> 16, dos_datetime & 0xFFFF
+    try:
+        mtime = int(time.mktime(((date >> 9) + 1980, (date >> 5) & 0xF, date & 0x1F,
+                                 time_ >> 11, (time_ >> 5) & 0x3F, (time_ & 0x1F) * 2, 0, 0, -1)))
+    except (OverflowError, ValueError):
+        return 0
+    return min(max(mtime, 0), 0xFFFFFFFF)
 
 
 def main(zip_file, mount_point):
-    fuse = FUSE(ZipFS(zip_file), mount_point, nothreads=True, foreground=True, ro=True)
+    # parallel central directory decoding is opt-in, see the README
+    parse_workers = int(os.environ.get('UFDR_PARSE_WORKERS', '1'))
+    options = {}
+    if sys.platform.startswith('linux'):
+        # only an upper bound: fusepy binds libfuse 2, which never raises the
+        # kernel's 32-page (128 KiB) limit per read request
+        options['max_read'] = CHUNK_SIZE
+    fuse = FUSE(ZipFS(zip_file, parse_workers), mount_point, foreground=True, ro=True,
+                # nothing under the mount ever changes, let the kernel keep
+                # attributes, name lookups and cached pages across opens
+                attr_timeout=3600, entry_timeout=3600, kernel_cache=True, **options)
 
 if __name__ == '__main__':
     if len(sys.argv) != 3:
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+try:
+    import mount
+except (ImportError, OSError) as e:  # fusepy raises OSError without libfuse
+    pytest.skip(f"fusepy unavailable: {e}", allow_module_level=True)
+
+TESTDATA = os.path.join(os.path.dirname(__file__), '..', 'testdata', 'test.ufdr')
+
+
+def _write(path, members, comment=b'', prefix=b''):
+    with zipfile.ZipFile(path, 'w') as z:
+        for name, data, compress_type in members:
+            z.writestr(name, data, compress_type)
+        z.comment = comment
+    if prefix:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        with open(path, 'wb') as f:
+            f.write(prefix + raw)
+    return path
+
+
+MEMBERS = [
+    ('dir/', b'', zipfile.ZIP_STORED),
+    ('dir/stored.bin', bytes(range(256)) * 40, zipfile.ZIP_STORED),
+    ('dir/deflated.txt', b'hello world ' * 5000, zipfile.ZIP_DEFLATED),
+    ('empty.txt', b'', zipfile.ZIP_STORED),
+    ('café.txt', b'utf-8 name', zipfile.ZIP_DEFLATED),
+]
+
+
+def assert_matches_zipfile(path, reference=None):
+    fs = mount.ZipFS(path)
+    with zipfile.ZipFile(reference or path) as z:
+        infos = z.infolist()
+        assert len(infos) == len(fs._sizes)
+        for index, info in enumerate(infos):
+            assert fs._sizes[index] == info.file_size
+            assert fs._compress_sizes[index] == info.compress_size
+            assert fs._header_offsets[index] == info.header_offset
+            assert fs._compress_types[index] == info.compress_type
+            assert fs._flags[index] == info.flag_bits
+            assert fs._mtimes[index] == time.mktime(info.date_time + (0, 0, -1))
+            if not info.is_dir():
+                path_in_mount = '/' + info.filename
+                assert fs.getattr(path_in_mount)['st_size'] == info.file_size
+                assert fs.read(path_in_mount, info.file_size + 1, 0, 0) == z.read(info)
+        # one nested listing against the names zipfile reports under it
+        nested = next((info.filename for info in infos if info.filename.strip('/').count('/')), None)
+        if nested is not None:
+            parent = nested.strip('/').rsplit('/', 1)[0] + '/'
+            children = {info.filename[len(parent):].split('/')[0] for info in infos
+                        if info.filename.startswith(parent) and info.filename != parent}
+            assert fs.readdir('/' + parent.rstrip('/'), 0) == ['.', '..'] + sorted(children)
+    fs.destroy('/')
+    return fs
+
+
+def test_testdata():
+    assert_matches_zipfile(TESTDATA)
+
+
+def test_stored_and_deflated(tmp_path):
+    assert_matches_zipfile(_write(tmp_path / 'plain.zip', MEMBERS))
+
+
+def test_comment_containing_end_signature(tmp_path):
+    # zipfile itself trips over this comment, so the same archive without
+    # it serves as the reference; the comment only follows the end record
+    comment = b'see PK\x05\x06 and more text after it'
+    path = _write(tmp_path / 'commented.zip', MEMBERS, comment=comment)
+    reference = _write(tmp_path / 'reference.zip', MEMBERS)
+    assert_matches_zipfile(path, reference)
+
+
+def test_comment(tmp_path):
+    assert_matches_zipfile(_write(tmp_path / 'commented.zip', MEMBERS, comment=b'plain comment'))
+
+
+def test_prepended_data(tmp_path):
+    prefix = b'<?xml version="1.0"?><report/>\n'
+    path = _write(tmp_path / 'prefixed.ufdr', MEMBERS, prefix=prefix)
+    fs = assert_matches_zipfile(path)
+    assert fs.zip_offset == len(prefix)
+
+    # the prefix is exposed as /metadata.xml next to the archive's members
+    fs = mount.ZipFS(path)
+    assert mount.METADATA_NAME in fs.readdir('/', 0)
+    assert fs.getattr(mount.METADATA_PATH)['st_size'] == len(prefix)
+    assert fs.open(mount.METADATA_PATH, os.O_RDONLY) == 0
+    assert fs.read(mount.METADATA_PATH, len(prefix) + 100, 0, 0) == prefix
+    assert fs.read(mount.METADATA_PATH, 10, len(prefix) - 4, 0) == prefix[-4:]
+    assert fs.read(mount.METADATA_PATH, 10, len(prefix), 0) == b''
+    assert fs.read(mount.METADATA_PATH, 10, len(prefix) + 50, 0) == b''
+    fs.destroy('/')
+
+    # an archive member of the same name takes precedence over the prefix
+    own = [(mount.METADATA_NAME, b'<member/>', zipfile.ZIP_DEFLATED)]
+    fs = mount.ZipFS(str(_write(tmp_path / 'own.ufdr', MEMBERS + own, prefix=prefix)))
+    assert fs.readdir('/', 0).count(mount.METADATA_NAME) == 1
+    assert fs.getattr(mount.METADATA_PATH)['st_size'] == len(b'<member/>')
+    assert fs.read(mount.METADATA_PATH, 100, 0, 0) == b'<member/>'
+    fs.destroy('/')
+
+    # a plain archive has no metadata entry
+    fs = mount.ZipFS(str(_write(tmp_path / 'plain.zip', MEMBERS)))
+    assert mount.METADATA_NAME not in fs.readdir('/', 0)
+    with pytest.raises(FileNotFoundError):
+        fs.getattr(mount.METADATA_PATH)
+    fs.destroy('/')
+
+
+def test_zip64(tmp_path, monkeypatch):
+    # lowered limits make zipfile write zip64 extra fields and end records
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 100)
+    monkeypatch.setattr(zipfile, 'ZIP_FILECOUNT_LIMIT', 2)
+    path = _write(tmp_path / 'zip64.zip', MEMBERS, prefix=b'junk')
+    monkeypatch.undo()
+    assert_matches_zipfile(path)
+
+
+@pytest.mark.parametrize('data', [b'', b'not a zip file at all', b'PK\x05\x06' + b'\0' * 10])
+def test_not_a_zip(tmp_path, data):
+    path = tmp_path / 'bad.zip'
+    path.write_bytes(data)
+    with pytest.raises(zipfile.BadZipFile):
+        mount.ZipFS(str(path))
+
+
+def test_parallel_decode_matches_serial(tmp_path, monkeypatch):
+    members = [(f'd{i % 7}/f{i}.txt', b'x' * i, zipfile.ZIP_DEFLATED) for i in range(50)]
+    path = str(_write(tmp_path / 'many.zip', members))
+    serial = mount.ZipFS(path)
+    monkeypatch.setattr(mount, 'PARALLEL_THRESHOLD', 10)
+    monkeypatch.setattr(mount, '_available_cpus', lambda: 4)
+    parallel = mount.ZipFS(path, parse_workers=3)
+    for field in ('_sizes', '_compress_sizes', '_header_offsets', '_compress_types',
+                  '_flags', '_mtimes', '_data_offsets', '_listings'):
+        assert getattr(parallel, field) == getattr(serial, field)